@@ -1,5 +1,5 @@
 import os
-import json
+import argparse
 import numpy as np
 from PIL import Image
 import cv2
@@ -8,14 +8,17 @@ from extractors.normalize_features import normalize_feature_dict, concatenate_fe
 from extractors.color_features import extract_color_moments
 from extractors.texture_features import extract_lbp, extract_haralick
 from extractors.keypoint_features import extract_orb
+from search_engine.index_store import index_lock, read_manifest, reset_manifest, write_json_atomic
+from search_engine.knn_graph import build_and_save_knn_graph, KNN_GRAPH_FILENAME
+from search_engine.ranking import stack_vectors
+from search_engine.projection import (
+    fit_pca, save_projection, projection_report, format_projection_report, PROJECTION_FILENAME
+)
 
+KNN_NEIGHBORS = 16
+KNN_BLOCK_SIZE = 1024
+KNN_TILE_SIZE = 4096
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray): return obj.tolist()
-        if isinstance(obj, np.integer): return int(obj)
-        if isinstance(obj, np.floating): return float(obj)
-        return super(NumpyEncoder, self).default(obj)
 
 def get_category_from_genre(genre_str):
     genre = genre_str.lower().replace('_', ' ').strip()
@@ -34,57 +37,126 @@ def get_category_from_genre(genre_str):
     }
     return mapping.get(genre, "Categoría desconocida")
 
-def create_database(dataset_path, output_path):
-    database = []
-    print(f"Iniciando procesamiento del dataset en: {dataset_path}")
+def create_entry(image_path, genre_folder_name):
+    """
+    Extrae, normaliza y concatena las características de una imagen.
 
-    for genre_folder_name in sorted(os.listdir(dataset_path)):
-        class_path = os.path.join(dataset_path, genre_folder_name)
-        if not os.path.isdir(class_path): continue
+    Args:
+        image_path: Ruta de la imagen.
+        genre_folder_name: Nombre de la carpeta de género de la imagen.
 
-        main_category = get_category_from_genre(genre_folder_name)
-        print(f"\nProcesando carpeta '{genre_folder_name}' como categoría: '{main_category}'...")
+    Returns:
+        dict: Item con el formato de database.json.
+    """
+    img_pil = Image.open(image_path).convert("RGB")
+    img_np = np.array(img_pil)
+    img_cv2 = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
 
-        for filename in sorted(os.listdir(class_path)):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                image_path = os.path.join(class_path, filename)
-                print(f"  - Procesando: {filename}")
-
-                try:
-                    img_pil = Image.open(image_path).convert("RGB")
-                    img_np = np.array(img_pil)
-                    img_cv2 = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-
-                    raw_features = {
-                        "color_moments": extract_color_moments(img_cv2), "lbp_histogram": extract_lbp(img_cv2),
-                        "haralick_features": extract_haralick(img_cv2), "orb": extract_orb(img_cv2)
-                    }
-
-                    # 2. Normalizar el diccionario de características
-                    normalized_features = normalize_feature_dict(raw_features)
+    raw_features = {
+        "color_moments": extract_color_moments(img_cv2), "lbp_histogram": extract_lbp(img_cv2),
+        "haralick_features": extract_haralick(img_cv2), "orb": extract_orb(img_cv2)
+    }
 
-                    # 3. Concatenar características en un solo vector (opcional)
-                    concatenated_vector = concatenate_features(normalized_features)
+    # 2. Normalizar el diccionario de características
+    normalized_features = normalize_feature_dict(raw_features)
 
-                    database_entry = {
-                        "id": os.path.splitext(filename)[0],
-                        "image_path": image_path,
-                        "class": main_category,
-                        "genre": genre_folder_name,
-                        "features": concatenated_vector
-                    }
-                    database.append(database_entry)
+    # 3. Concatenar características en un solo vector (opcional)
+    concatenated_vector = concatenate_features(normalized_features)
 
-                except Exception as e:
-                    print(f"    -> Error procesando {filename}: {e}")
+    return {
+        "id": os.path.splitext(os.path.basename(image_path))[0],
+        "image_path": image_path,
+        "class": get_category_from_genre(genre_folder_name),
+        "genre": genre_folder_name,
+        "features": concatenated_vector
+    }
 
-    print(f"\nProcesamiento completado. Guardando base de datos en {output_path}...")
-    with open(output_path, 'w') as f:
-        json.dump(database, f, cls=NumpyEncoder, indent=4)
-    print(f"¡Base de datos creada exitosamente con {len(database)} imágenes!")
+def create_projection(database, data_dir, target_variance, whiten=True):
+    """
+    Ajusta la PCA sobre las características de la base de datos, la guarda
+    junto al índice e imprime la comparación con el vector completo.
+    """
+    db_vectors = [(item["id"], np.array(item["features"], dtype=np.float32))
+                  for item in database if "features" in item]
+    ids, matrix = stack_vectors(db_vectors)
+    projection = fit_pca(matrix, target_variance, whiten)
+    save_projection(os.path.join(data_dir, PROJECTION_FILENAME), projection)
+
+    explained = float(np.sum(projection["explained_variance_ratio"]))
+    print(f"PCA: {matrix.shape[1]} -> {len(projection['scales'])} dimensiones "
+          f"({explained:.2%} de la varianza explicada).")
+
+    class_by_id = {item["id"]: item["class"] for item in database}
+    report = projection_report(ids, matrix, [class_by_id[i] for i in ids], projection)
+    print(format_projection_report(report))
+
+def create_database(dataset_path, output_path, pca_variance=None, pca_whiten=True):
+    # Se valida antes de escribir nada: un error tras reemplazar database.json
+    # dejaría el manifiesto y la proyección anteriores junto a la base nueva
+    if pca_variance is not None and not 0 < pca_variance <= 1:
+        raise ValueError("pca_variance debe estar en el intervalo (0, 1].")
+
+    data_dir = os.path.dirname(output_path)
+
+    # Se mantiene el bloqueo del índice durante toda la reconstrucción: un
+    # 'update_index.py add' concurrente espera y su segmento se agrega después
+    # de reset_manifest, en lugar de descartarse con los segmentos anteriores.
+    with index_lock(data_dir):
+        database = []
+        print(f"Iniciando procesamiento del dataset en: {dataset_path}")
+
+        # Las obras eliminadas desde update_index.py no vuelven a la base
+        manifest = read_manifest(data_dir)
+        deleted_ids = set(manifest["deleted"]) | set(manifest["tombstones"])
+
+        for genre_folder_name in sorted(os.listdir(dataset_path)):
+            class_path = os.path.join(dataset_path, genre_folder_name)
+            if not os.path.isdir(class_path): continue
+
+            main_category = get_category_from_genre(genre_folder_name)
+            print(f"\nProcesando carpeta '{genre_folder_name}' como categoría: '{main_category}'...")
+
+            for filename in sorted(os.listdir(class_path)):
+                if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                    if os.path.splitext(filename)[0] in deleted_ids: continue
+                    image_path = os.path.join(class_path, filename)
+                    print(f"  - Procesando: {filename}")
+
+                    try:
+                        database.append(create_entry(image_path, genre_folder_name))
+                    except Exception as e:
+                        print(f"    -> Error procesando {filename}: {e}")
+
+        print(f"\nProcesamiento completado. Guardando base de datos en {output_path}...")
+        write_json_atomic(output_path, database, indent=4)
+
+        print(f"Calculando grafo de {KNN_NEIGHBORS} vecinos más cercanos...")
+        build_and_save_knn_graph(database, os.path.join(data_dir, KNN_GRAPH_FILENAME),
+                                 k=KNN_NEIGHBORS, block_size=KNN_BLOCK_SIZE,
+                                 tile_size=KNN_TILE_SIZE)
+
+        projection_path = os.path.join(data_dir, PROJECTION_FILENAME)
+        if pca_variance is not None:
+            create_projection(database, data_dir, pca_variance, pca_whiten)
+        elif os.path.exists(projection_path):
+            # Una proyección de una base anterior ya no corresponde a esta
+            os.remove(projection_path)
+
+        # La base reconstruida ya incluye las obras de los segmentos pendientes
+        reset_manifest(data_dir)
+        print(f"¡Base de datos creada exitosamente con {len(database)} imágenes!")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Construye la base de datos de características.")
+    parser.add_argument("--pca-variance", type=float, default=None,
+                        help="Ajusta una PCA que conserve esta fracción de la varianza (p. ej. 0.95).")
+    parser.add_argument("--no-whiten", action="store_true", help="Desactiva el blanqueo de la PCA.")
+    args = parser.parse_args()
+    if args.pca_variance is not None and not 0 < args.pca_variance <= 1:
+        parser.error("--pca-variance debe estar en el intervalo (0, 1].")
+
     DATASET_FOLDER = 'dataset/wikiart'
     OUTPUT_JSON_PATH = 'data/database.json'
     os.makedirs('data', exist_ok=True)
-    create_database(dataset_path=DATASET_FOLDER, output_path=OUTPUT_JSON_PATH)
\ No newline at end of file
+    create_database(dataset_path=DATASET_FOLDER, output_path=OUTPUT_JSON_PATH,
+                    pca_variance=args.pca_variance, pca_whiten=not args.no_whiten)
\ No newline at end of file
@@ -11,6 +11,15 @@ import numpy as np
 
 eps = 1e-10
 
+# Orden fijo de los bloques dentro del vector concatenado y su dimensión
+FEATURE_ORDER = ["color_moments", "lbp_histogram", "haralick_features", "orb"]
+FEATURE_DIMS = {
+    "color_moments": 9,
+    "lbp_histogram": 58,
+    "haralick_features": 4,
+    "orb": 32,
+}
+
 
 def normalize_histogram(h):
     """
@@ -77,12 +86,9 @@ def concatenate_features(normalized_feat_dict):
 
     El orden de concatenación es importante y debe ser consistente.
     """
-    # Define un orden fijo para asegurar consistencia
-    feature_order = ["color_moments", "lbp_histogram", "haralick_features", "orb"]
-    
     # Crea una lista de vectores de características en el orden definido
     vectors_to_join = []
-    for key in feature_order:
+    for key in FEATURE_ORDER:
         if key in normalized_feat_dict and normalized_feat_dict[key] is not None:
             vectors_to_join.append(normalized_feat_dict[key].flatten())
 
@@ -91,3 +97,19 @@ def concatenate_features(normalized_feat_dict):
         return np.array([])
         
     return np.concatenate(vectors_to_join)
+
+
+def feature_block_slices():
+    """
+    Devuelve la posición de cada bloque dentro del vector concatenado.
+
+    Returns:
+        dict: Diccionario que mapea cada característica a su `slice` dentro
+              del vector generado por concatenate_features.
+    """
+    slices = {}
+    start = 0
+    for key in FEATURE_ORDER:
+        slices[key] = slice(start, start + FEATURE_DIMS[key])
+        start += FEATURE_DIMS[key]
+    return slices
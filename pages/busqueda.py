@@ -2,11 +2,20 @@ import streamlit as st
 import numpy as np
 import cv2
 from PIL import Image
-import json
 import os
+from collections import ChainMap
 
 from extractors.normalize_features import normalize_feature_dict, concatenate_features
-from search_engine.ranking import rank_images_by_single_vector
+from search_engine.ranking import (
+    rank_images_by_single_vector, build_cascade_index, rank_images_cascade,
+    recall_at_k, sample_cascade_recall, stack_vectors, rank_images_by_matrix, cascade_stages_for,
+    DEFAULT_CASCADE_STAGES
+)
+from search_engine.projection import load_projection, apply_projection, PROJECTION_FILENAME
+from search_engine.index_store import DATA_DIR, read_manifest, read_main, read_segment, search_segments
+from search_engine.knn_graph import (
+    load_knn_graph, graph_neighbors, rank_images_by_graph_search, KNN_GRAPH_FILENAME
+)
 from search_engine.similarity import l2_dist, chi_square, hamming_dist
 from extractors.color_features import extract_color_moments
 from extractors.texture_features import extract_lbp, extract_haralick
@@ -23,23 +32,17 @@ st.title("Buscar por Imagen")
 st.write("Sube una imagen para buscar obras similares en el dataset.")
 
 # --- 1. CARGA DE DATOS OPTIMIZADA ---
-@st.cache_resource
-def load_database_and_vectors():
+def build_index_view(items, projection=None):
     """
-    Carga la base de datos y extrae los vectores de características pre-calculados.
+    Extrae los vectores pre-calculados de una lista de items (base principal
+    o segmento) y prepara las estructuras usadas por los rankings. Si hay una
+    proyección PCA, también guarda los vectores proyectados.
     """
-    try:
-        with open("data/database.json") as f:
-            database = json.load(f)
-    except FileNotFoundError:
-        st.error("No se encontró el archivo 'data/database.json'.")
-        return [], {}, {}
-
     db_vectors = []
     db_by_id = {}
-    
-    for item in database:
-        # Asumimos que el vector concatenado está guardado bajo la clave 'concatenated_features'
+
+    for item in items:
+        # Asumimos que el vector concatenado está guardado bajo la clave 'features'
         if 'features' in item:
             # Convierte la lista del JSON a un array de NumPy
             vector = np.array(item['features'], dtype=np.float32)
@@ -49,70 +52,236 @@ def load_database_and_vectors():
             # Opcional: Advertir si un item no tiene el vector pre-calculado
             st.warning(f"El item con ID {item.get('id', 'desconocido')} no tiene un vector de características pre-calculado.")
 
-    return db_vectors, db_by_id
+    ids, matrix = stack_vectors(db_vectors)
+    view = {
+        "vectors": db_vectors,
+        "by_id": db_by_id,
+        "id_set": set(db_by_id),
+        "ids": ids,
+        "matrix": matrix,
+        "cascade": build_cascade_index(db_vectors),
+    }
+    if projection is not None:
+        view["projected"] = apply_projection(projection, matrix)
+    return view
+
+@st.cache_resource(max_entries=1)
+def load_projection_for(main_generation):
+    """
+    Carga la proyección PCA guardada por build_database.py, si existe. Cambia
+    junto con la base principal, así que comparte su generación como clave.
+    """
+    return load_projection(os.path.join(DATA_DIR, PROJECTION_FILENAME))
+
+@st.cache_resource(max_entries=1)
+def load_main_view(main_generation):
+    """
+    Carga la base de datos principal. Solo se vuelve a leer cuando una
+    compactación o una reconstrucción cambian 'main_generation'.
+    """
+    try:
+        database = read_main()
+    except FileNotFoundError:
+        st.error("No se encontró el archivo 'data/database.json'.")
+        database = []
+    view = build_index_view(database, load_projection_for(main_generation))
+
+    # El grafo kNN solo se usa si corresponde exactamente a esta base principal
+    graph = load_knn_graph(os.path.join(DATA_DIR, KNN_GRAPH_FILENAME))
+    if graph is not None and graph["ids"] == view["ids"]:
+        view["graph"] = graph
+    return view
+
+@st.cache_resource(max_entries=256)
+def load_segment_view(segment_name, main_generation):
+    """
+    Carga un segmento. Los segmentos son inmutables, así que basta su nombre
+    (y la generación de la proyección PCA vigente) como clave de caché.
+    """
+    return build_index_view(read_segment(segment_name), load_projection_for(main_generation))
+
+def load_index_views():
+    """
+    Lee el manifiesto en cada ejecución de la página para recoger los segmentos
+    y lápidas nuevos sin reiniciar la aplicación.
+    """
+    for _ in range(3):
+        manifest = read_manifest()
+        try:
+            views = [load_main_view(manifest["main_generation"])]
+            views += [load_segment_view(name, manifest["main_generation"]) for name in manifest["segments"]]
+            projection = load_projection_for(manifest["main_generation"])
+            return views, manifest, projection
+        except FileNotFoundError:
+            # Una compactación eliminó un segmento entre la lectura del
+            # manifiesto y la del segmento: se reintenta con el manifiesto nuevo
+            continue
+    st.error("No se pudo leer un estado consistente del índice.")
+    return [], read_manifest(), None
+
+index_views, manifest, projection = load_index_views()
+tombstones = manifest["tombstones"]
+main_generation = manifest["main_generation"]
+db_by_id = ChainMap(*[view["by_id"] for view in reversed(index_views)])
+
+def linear_rank(distance_fn):
+    return lambda q, view, k: rank_images_by_single_vector(q, view["vectors"], distance_fn, top_k=k)
+
+def cascade_rank(stages):
+    return lambda q, view, k: rank_images_cascade(q, view["cascade"], stages, top_k=k)
+
+def graph_rank(q, view, k):
+    # Los segmentos no tienen grafo: se recorren linealmente
+    if "graph" in view:
+        return rank_images_by_graph_search(q, view["graph"], view["matrix"], top_k=k)
+    return rank_images_by_single_vector(q, view["vectors"], l2_dist, top_k=k)
+
+def pca_rank(q, view, k):
+    # 'q' ya viene proyectado al espacio de la PCA
+    return rank_images_by_matrix(q, view["ids"], view["projected"], top_k=k)
+
+@st.cache_resource(max_entries=16)
+def load_cascade_recall(main_generation, coarse_keep, lbp_keep, top_k):
+    """
+    Mide el recall de la cascada sobre una muestra de la base principal, una
+    sola vez por base y configuración de etapas, fuera de la ruta de búsqueda.
+    """
+    stages = cascade_stages_for(coarse_keep, lbp_keep)
+    return sample_cascade_recall(load_main_view(main_generation)["cascade"], stages, top_k)
+
+def show_similar(item_id):
+    st.session_state["similar_to"] = item_id
+
+def show_results(results, key):
+    """
+    Muestra una cuadrícula de resultados con un botón para ver obras similares.
+    """
+    if not results:
+        st.warning("No se encontraron resultados. Asegúrate de que la forma de los vectores coincida.")
+        return
+    cols = st.columns(5)
+    for i, (dist, item_id) in enumerate(results):
+        with cols[i % 5]:
+            item = db_by_id[item_id]
+            st.image(item["image_path"], caption=f"Dist: {dist:.4f}")
+            st.button("Más como esta", key=f"{key}-{item_id}", on_click=show_similar, args=(item_id,))
+
+def find_similar(item_id, top_k):
+    """
+    Busca obras similares a un resultado. Si la obra está en el grafo kNN de la
+    base principal se leen sus vecinos precalculados; si está en un segmento
+    aún no compactado se usa su vector guardado con un recorrido lineal.
+    """
+    main_view = index_views[0]
+    in_segment = any(item_id in view["id_set"] for view in index_views[1:])
+    if "graph" in main_view and not in_segment:
+        return graph_neighbors(main_view["graph"], item_id, top_k, excluded=tombstones)
+
+    vector = np.array(db_by_id[item_id]["features"], dtype=np.float32)
+    results = search_segments(vector, index_views, tombstones, linear_rank(l2_dist), top_k=top_k + 1)
+    return [r for r in results if r[1] != item_id][:top_k]
 
-# Carga los datos una sola vez
-db_concatenated_vectors, db_by_id = load_database_and_vectors()
+
+# Tamaños de las etapas de la cascada (ajustables desde la barra lateral)
+with st.sidebar.expander("Búsqueda en cascada"):
+    coarse_keep = st.number_input(
+        "Candidatos tras la etapa de color + Haralick", min_value=20, max_value=5000,
+        value=DEFAULT_CASCADE_STAGES[0]["keep"], step=10
+    )
+    # Una etapa posterior no puede conservar más candidatos que la anterior
+    lbp_keep = st.number_input(
+        "Candidatos tras la etapa Chi-cuadrado de LBP", min_value=20, max_value=int(coarse_keep),
+        value=min(DEFAULT_CASCADE_STAGES[1]["keep"], int(coarse_keep)), step=10
+    )
+cascade_stages = cascade_stages_for(coarse_keep, lbp_keep)
 
 
 uploaded_file = st.file_uploader("Selecciona una imagen de consulta", type=["jpg", "jpeg", "png"])
 
-if uploaded_file and db_concatenated_vectors:
+if uploaded_file and any(view["id_set"] for view in index_views):
     st.image(uploaded_file, caption="Imagen de consulta", width=300)
 
+    K = 20
+
     # --- 2. PROCESAMIENTO SOLO PARA LA IMAGEN DE CONSULTA ---
-    img = Image.open(uploaded_file).convert("RGB")
-    img_np = np.array(img)
-    img_cv2 = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-
-    # Extrae, normaliza y concatena características solo para la imagen nueva
-    raw_features = {
-        "color_moments": extract_color_moments(img_cv2), 
-        "lbp_histogram": extract_lbp(img_cv2),
-        "haralick_features": extract_haralick(img_cv2), 
-        "orb": extract_orb(img_cv2)
-    }
-    normalized_features = normalize_feature_dict(raw_features)
-    query_vector = concatenate_features(normalized_features)
-    
+    # Cada clic en "Más como esta" vuelve a ejecutar la página: el vector de la
+    # consulta se guarda en la sesión y solo se extrae al subir otro archivo.
+    if st.session_state.get("query_file_id") != uploaded_file.file_id:
+        img = Image.open(uploaded_file).convert("RGB")
+        img_np = np.array(img)
+        img_cv2 = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
+
+        # Extrae, normaliza y concatena características solo para la imagen nueva
+        raw_features = {
+            "color_moments": extract_color_moments(img_cv2), 
+            "lbp_histogram": extract_lbp(img_cv2),
+            "haralick_features": extract_haralick(img_cv2), 
+            "orb": extract_orb(img_cv2)
+        }
+        normalized_features = normalize_feature_dict(raw_features)
+        st.session_state["query_vector"] = concatenate_features(normalized_features)
+        st.session_state["query_file_id"] = uploaded_file.file_id
+        st.session_state.pop("similar_to", None)
+    query_vector = st.session_state["query_vector"]
+
     # --- 3. BÚSQUEDA Y RANKING ---
-    st.write("Calculando similitud...")
-    K = 20
-    
-    # Usa la función de ranking con el vector de consulta y los vectores pre-calculados
-    results1 = rank_images_by_single_vector(query_vector, db_concatenated_vectors, l2_dist, top_k=K)
-    results2 = rank_images_by_single_vector(query_vector, db_concatenated_vectors, chi_square, top_k=K)
-    results3 = rank_images_by_single_vector(query_vector, db_concatenated_vectors, hamming_dist, top_k=K)
+    # Los resultados también se guardan en la sesión y solo se recalculan si
+    # cambia la consulta, el índice (manifiesto) o el tamaño de las etapas.
+    results_key = (uploaded_file.file_id, manifest["generation"], int(coarse_keep), int(lbp_keep))
+    if st.session_state.get("query_results_key") != results_key:
+        st.write("Calculando similitud...")
+
+        # Usa la función de ranking con el vector de consulta y los vectores pre-calculados,
+        # buscando en la base principal y en cada segmento y combinando los resultados
+        results = {
+            "l2": search_segments(query_vector, index_views, tombstones, linear_rank(l2_dist), top_k=K),
+            "chi": search_segments(query_vector, index_views, tombstones, linear_rank(chi_square), top_k=K),
+            "hamming": search_segments(query_vector, index_views, tombstones, linear_rank(hamming_dist), top_k=K),
+            "cascade": search_segments(query_vector, index_views, tombstones, cascade_rank(cascade_stages), top_k=K),
+            "graph": search_segments(query_vector, index_views, tombstones, graph_rank, top_k=K),
+            "pca": [],
+        }
+        if projection is not None and query_vector.shape == projection["mean"].shape:
+            results["pca"] = search_segments(apply_projection(projection, query_vector), index_views, tombstones, pca_rank, top_k=K)
+        st.session_state["query_results"] = results
+        st.session_state["query_results_key"] = results_key
+    results = st.session_state["query_results"]
+
+    recall4 = load_cascade_recall(main_generation, int(coarse_keep), int(lbp_keep), K)
+    recall5 = recall_at_k(results["graph"], results["l2"])
+    recall6 = recall_at_k(results["pca"], results["l2"])
 
     # --- 4. MOSTRAR RESULTADOS ---
+    similar_to = st.session_state.get("similar_to")
+    if similar_to in db_by_id:
+        st.header("Obras similares a la seleccionada")
+        st.image(db_by_id[similar_to]["image_path"], caption=similar_to, width=200)
+        show_results(find_similar(similar_to, 10), "similar")
+
     st.header("Resultados de la Búsqueda con L2 Distance")
-    if not results1:
-        st.warning("No se encontraron resultados. Asegúrate de que la forma de los vectores coincida.")
-    else:
-        cols = st.columns(5)
-        for i, (dist, item_id) in enumerate(results1):
-            with cols[i % 5]:
-                item = db_by_id[item_id]
-                st.image(item["image_path"], caption=f"Dist: {dist:.4f}")
+    show_results(results["l2"], "l2")
+
     st.header("Resultados de la Búsqueda con Chi-Square")
-    if not results2:
-        st.warning("No se encontraron resultados. Asegúrate de que la forma de los vectores coincida.")
-    else:
-        cols = st.columns(5)
-        for i, (dist, item_id) in enumerate(results2):
-            with cols[i % 5]:
-                item = db_by_id[item_id]
-                st.image(item["image_path"], caption=f"Dist: {dist:.4f}")
+    show_results(results["chi"], "chi")
 
     st.header("Resultados de la Búsqueda con Hamming Distance")
-    if not results3:
-        st.warning("No se encontraron resultados. Asegúrate de que la forma de los vectores coincida.")
-    else:
-        cols = st.columns(5)
-        for i, (dist, item_id) in enumerate(results3):
-            with cols[i % 5]:
-                item = db_by_id[item_id]
-                st.image(item["image_path"], caption=f"Dist: {dist:.4f}")
+    show_results(results["hamming"], "hamming")
+
+    st.header("Resultados de la Búsqueda en Cascada")
+    st.caption(f"Recall@{K} frente a la búsqueda exhaustiva con L2 (medido sobre una muestra de la base): {recall4:.2%}")
+    show_results(results["cascade"], "cascade")
+
+    st.header("Resultados de la Búsqueda en el Grafo kNN")
+    if "graph" not in index_views[0]:
+        st.info("No hay un grafo kNN vigente; ejecuta build_database.py. Se usó el recorrido lineal.")
+    st.caption(f"Recall@{K} frente a la búsqueda exhaustiva con L2: {recall5:.2%}")
+    show_results(results["graph"], "graph")
+
+    if projection is not None:
+        st.header("Resultados de la Búsqueda con L2 sobre PCA")
+        st.caption(f"{len(projection['scales'])} dimensiones en lugar de {projection['mean'].shape[0]}. "
+                   f"Recall@{K} frente a la búsqueda exhaustiva con L2: {recall6:.2%}")
+        show_results(results["pca"], "pca")
 
 with open("assets/footer.html", "r", encoding="utf-8") as f:
     st.markdown(f.read(), unsafe_allow_html=True)
\ No newline at end of file
@@ -0,0 +1,396 @@
+"""
+    Almacén actualizable del índice de características.
+
+    La base de datos principal (`data/database.json`) se complementa con
+    segmentos pequeños de solo escritura al final (append-only) y con una lista
+    de lápidas (tombstones) que marca las obras eliminadas. Además, la lista
+    'deleted' guarda de forma permanente los IDs eliminados para que una
+    reconstrucción completa con `build_database.py` no los vuelva a incluir. Un manifiesto
+    (`data/index_manifest.json`) describe qué segmentos y lápidas están vigentes;
+    se reescribe de forma atómica con `os.replace`, por lo que los procesos
+    de la aplicación siempre ven un estado completo y pueden recargar los
+    segmentos nuevos sin reiniciar.
+
+    La compactación fusiona los segmentos en la base principal, aplica las
+    lápidas, recalcula el grafo kNN y deja el manifiesto sin segmentos. Puede ejecutarse en segundo
+    plano con `start_background_compaction`.
+"""
+
+import os
+import json
+import time
+import heapq
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from search_engine.knn_graph import build_and_save_knn_graph, KNN_GRAPH_FILENAME
+
+DATA_DIR = "data"
+MAIN_FILENAME = "database.json"
+MANIFEST_FILENAME = "index_manifest.json"
+SEGMENTS_DIRNAME = "segments"
+LOCK_FILENAME = "index.lock"
+
+
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray): return obj.tolist()
+        if isinstance(obj, np.integer): return int(obj)
+        if isinstance(obj, np.floating): return float(obj)
+        return super(NumpyEncoder, self).default(obj)
+
+
+def _empty_manifest():
+    return {"generation": 0, "main_generation": 0, "next_segment": 1,
+            "segments": [], "tombstones": [], "deleted": []}
+
+
+def write_json_atomic(path, obj, indent=None):
+    """
+    Escribe un JSON de forma atómica.
+
+    El contenido se escribe primero en un archivo temporal del mismo
+    directorio y luego se reemplaza el destino con `os.replace`, de modo que
+    un lector nunca encuentra el archivo a medio escribir.
+
+    Args:
+        path (str): Ruta del archivo destino.
+        obj: Objeto serializable a JSON.
+        indent (int): Sangría opcional del JSON.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, cls=NumpyEncoder, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _try_lock_file(fd):
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock_file(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def index_lock(data_dir=DATA_DIR, timeout=None):
+    """
+    Bloqueo entre procesos para las operaciones que modifican el índice.
+
+    Solo lo necesitan los escritores (agregar, eliminar, compactar, reconstruir);
+    los lectores se apoyan en que el manifiesto se reemplaza de forma atómica.
+    Es un bloqueo del sistema operativo sobre `data/index.lock`, así que se
+    libera solo si el proceso que lo tiene termina, incluso con kill -9.
+
+    Args:
+        data_dir (str): Directorio de datos del índice.
+        timeout (float): Segundos máximos de espera por el bloqueo. Si es None
+                         se espera indefinidamente.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    lock_path = os.path.join(data_dir, LOCK_FILENAME)
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    try:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not _try_lock_file(fd):
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"No se pudo obtener el bloqueo del índice: {lock_path}")
+            time.sleep(0.05)
+        try:
+            yield
+        finally:
+            _unlock_file(fd)
+    finally:
+        os.close(fd)
+
+
+def read_manifest(data_dir=DATA_DIR):
+    """
+    Lee el manifiesto del índice.
+
+    Args:
+        data_dir (str): Directorio de datos del índice.
+
+    Returns:
+        dict: Manifiesto con las claves 'generation', 'main_generation',
+              'next_segment', 'segments', 'tombstones' y 'deleted'. Si todavía no existe
+              se devuelve un manifiesto vacío (solo la base principal).
+    """
+    try:
+        with open(os.path.join(data_dir, MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return _empty_manifest()
+    return dict(_empty_manifest(), **manifest)
+
+
+def _write_manifest(manifest, data_dir):
+    manifest["generation"] += 1
+    write_json_atomic(os.path.join(data_dir, MANIFEST_FILENAME), manifest, indent=4)
+
+
+def read_main(data_dir=DATA_DIR):
+    """
+    Carga los items de la base de datos principal.
+    """
+    with open(os.path.join(data_dir, MAIN_FILENAME)) as f:
+        return json.load(f)
+
+
+def read_segment(segment_name, data_dir=DATA_DIR):
+    """
+    Carga los items de un segmento. Los segmentos nunca se modifican una vez
+    escritos, así que su contenido puede guardarse en caché por nombre.
+    """
+    with open(os.path.join(data_dir, SEGMENTS_DIRNAME, segment_name)) as f:
+        return json.load(f)
+
+
+def append_segment(entries, data_dir=DATA_DIR):
+    """
+    Agrega nuevas obras al índice en un segmento nuevo.
+
+    Si alguna obra había sido eliminada, vuelve a estar vigente, y si un ID ya existía en la
+    base principal o en un segmento anterior, la versión nueva lo reemplaza.
+
+    Args:
+        entries (list): Items con el mismo formato que database.json.
+        data_dir (str): Directorio de datos del índice.
+
+    Returns:
+        str: Nombre del segmento creado.
+    """
+    os.makedirs(os.path.join(data_dir, SEGMENTS_DIRNAME), exist_ok=True)
+    with index_lock(data_dir):
+        manifest = read_manifest(data_dir)
+        segment_name = f"segment_{manifest['next_segment']:06d}.json"
+        write_json_atomic(os.path.join(data_dir, SEGMENTS_DIRNAME, segment_name), entries)
+
+        new_ids = {entry["id"] for entry in entries}
+        manifest["segments"].append(segment_name)
+        manifest["next_segment"] += 1
+        manifest["tombstones"] = [i for i in manifest["tombstones"] if i not in new_ids]
+        manifest["deleted"] = [i for i in manifest["deleted"] if i not in new_ids]
+        _write_manifest(manifest, data_dir)
+    return segment_name
+
+
+def delete_items(item_ids, data_dir=DATA_DIR):
+    """
+    Registra lápidas para las obras indicadas.
+
+    Las obras dejan de aparecer en las búsquedas de inmediato y se eliminan
+    físicamente en la siguiente compactación. Sus IDs también se agregan a la
+    lista permanente 'deleted', que sobrevive a la compactación.
+
+    Args:
+        item_ids (list): IDs de las obras a eliminar.
+        data_dir (str): Directorio de datos del índice.
+    """
+    with index_lock(data_dir):
+        manifest = read_manifest(data_dir)
+        tombstones = set(manifest["tombstones"])
+        manifest["tombstones"] += [i for i in item_ids if i not in tombstones]
+        deleted = set(manifest["deleted"])
+        manifest["deleted"] += [i for i in item_ids if i not in deleted]
+        _write_manifest(manifest, data_dir)
+
+
+def merge_live_items(main_items, segment_items, tombstones):
+    """
+    Combina la base principal y los segmentos en una sola lista de items.
+
+    Los segmentos se aplican en orden, así que un ID repetido conserva su
+    versión más reciente; los IDs con lápida se descartan.
+
+    Args:
+        main_items (list): Items de la base principal.
+        segment_items (list): Listas de items de cada segmento, en orden.
+        tombstones (iterable): IDs eliminados.
+
+    Returns:
+        list: Items vigentes del índice.
+    """
+    live = {}
+    for items in [main_items] + list(segment_items):
+        for item in items:
+            live[item["id"]] = item
+    tombstones = set(tombstones)
+    return [item for item_id, item in live.items() if item_id not in tombstones]
+
+
+def compact_index(data_dir=DATA_DIR):
+    """
+    Fusiona todos los segmentos en la base principal y aplica las lápidas.
+
+    La fusión y el grafo kNN se calculan sobre una copia del manifiesto sin
+    tomar el bloqueo, así que agregar o eliminar obras no espera a la
+    compactación. El bloqueo solo se toma para reemplazar los archivos y el
+    manifiesto: los segmentos y lápidas creados mientras tanto se conservan,
+    y si otra compactación o una reconstrucción cambió la base principal, el
+    resultado se descarta.
+
+    La base principal se reemplaza antes que el manifiesto: un lector que
+    todavía use el manifiesto anterior ve los mismos items duplicados entre la
+    base nueva y los segmentos viejos, y la fusión por ID los resuelve.
+
+    Args:
+        data_dir (str): Directorio de datos del índice.
+
+    Returns:
+        int: Número de segmentos fusionados.
+    """
+    snapshot = read_manifest(data_dir)
+    segments = list(snapshot["segments"])
+    if not segments and not snapshot["tombstones"]:
+        return 0
+
+    main_path = os.path.join(data_dir, MAIN_FILENAME)
+    graph_path = os.path.join(data_dir, KNN_GRAPH_FILENAME)
+    tmp_main_path = f"{main_path}.compact-{os.getpid()}"
+    tmp_graph_path = f"{graph_path}.compact-{os.getpid()}"
+    try:
+        items = merge_live_items(
+            read_main(data_dir),
+            [read_segment(name, data_dir) for name in segments],
+            snapshot["tombstones"]
+        )
+        write_json_atomic(tmp_main_path, items, indent=4)
+        build_and_save_knn_graph(items, tmp_graph_path)
+
+        with index_lock(data_dir):
+            manifest = read_manifest(data_dir)
+            if manifest["main_generation"] != snapshot["main_generation"]:
+                return 0
+
+            os.replace(tmp_main_path, main_path)
+            os.replace(tmp_graph_path, graph_path)
+
+            # Se conservan los segmentos y lápidas posteriores a la copia;
+            # 'deleted' también se conserva: la compactación solo consume las lápidas
+            merged_tombstones = set(snapshot["tombstones"])
+            manifest["segments"] = [name for name in manifest["segments"] if name not in segments]
+            manifest["tombstones"] = [i for i in manifest["tombstones"] if i not in merged_tombstones]
+            manifest["main_generation"] += 1
+            _write_manifest(manifest, data_dir)
+    finally:
+        for path in (tmp_main_path, tmp_graph_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Los segmentos fusionados ya no están referenciados por el manifiesto
+    for name in segments:
+        try:
+            os.remove(os.path.join(data_dir, SEGMENTS_DIRNAME, name))
+        except FileNotFoundError:
+            pass
+    return len(segments)
+
+
+def reset_manifest(data_dir=DATA_DIR):
+    """
+    Marca una base principal recién reconstruida por `build_database.py`.
+
+    Los segmentos pendientes se descartan, porque la reconstrucción vuelve a
+    procesar todo el dataset; las lápidas y la lista 'deleted' se conservan
+    para que una obra eliminada no reaparezca.
+
+    Debe llamarse con `index_lock` tomado durante toda la reconstrucción, para
+    que no se descarte un segmento agregado después de listar el dataset.
+    """
+    manifest = read_manifest(data_dir)
+    segments = manifest["segments"]
+    manifest["segments"] = []
+    manifest["main_generation"] += 1
+    _write_manifest(manifest, data_dir)
+
+    for name in segments:
+        try:
+            os.remove(os.path.join(data_dir, SEGMENTS_DIRNAME, name))
+        except FileNotFoundError:
+            pass
+
+
+def start_background_compaction(data_dir=DATA_DIR, interval=300.0, min_segments=4):
+    """
+    Lanza un hilo que compacta el índice periódicamente.
+
+    Args:
+        data_dir (str): Directorio de datos del índice.
+        interval (float): Segundos entre revisiones.
+        min_segments (int): Cantidad mínima de segmentos para compactar.
+
+    Returns:
+        threading.Event: Evento que detiene el hilo al activarse.
+    """
+    stop_event = threading.Event()
+
+    def _worker():
+        while not stop_event.wait(interval):
+            # Un error en una ronda no debe detener las siguientes
+            try:
+                manifest = read_manifest(data_dir)
+                if len(manifest["segments"]) >= min_segments:
+                    merged = compact_index(data_dir)
+                    print(f"Compactación completada: {merged} segmentos fusionados.")
+            except Exception as e:
+                print(f"Error en la compactación en segundo plano: {e}")
+
+    threading.Thread(target=_worker, daemon=True).start()
+    return stop_event
+
+
+def search_segments(query_vector, segment_views, tombstones, rank_fn, top_k=20):
+    """
+    Busca en la base principal y en cada segmento y combina los resultados.
+
+    Cada vista se ordena por separado con `rank_fn`. Los resultados de una
+    vista se ocultan si el ID tiene lápida o si un segmento posterior trae
+    una versión más nueva de la misma obra.
+
+    Args:
+        query_vector (np.array): Vector de la imagen de consulta.
+        segment_views (list): Vistas en orden (base principal primero). Cada
+                              vista es un dict con al menos la clave 'id_set'
+                              (conjunto de IDs que contiene).
+        tombstones (iterable): IDs eliminados.
+        rank_fn (function): Función rank_fn(query_vector, view, k) que devuelve
+                            una lista de tuplas (distancia, item_id).
+        top_k (int): El número de resultados a devolver.
+
+    Returns:
+        list: Una lista de tuplas (distancia, item_id) para los 'top_k' mejores resultados.
+    """
+    hidden = set(tombstones)
+    per_view = []
+    for position, view in enumerate(reversed(segment_views)):
+        # Se piden tantos resultados extra como IDs ocultos tenga la vista
+        overfetch = len(hidden & view["id_set"])
+        results = rank_fn(query_vector, view, top_k + overfetch)
+        per_view.append([r for r in results if r[1] not in hidden])
+        if position < len(segment_views) - 1:
+            hidden = hidden | view["id_set"]
+
+    return list(heapq.merge(*per_view, key=lambda x: x[0]))[:top_k]
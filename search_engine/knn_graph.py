@@ -0,0 +1,219 @@
+"""
+    Grafo de k vecinos más cercanos (kNN) sobre los vectores de la base de datos.
+
+    El grafo se calcula una sola vez en `build_database.py` (y tras cada
+    compactación) con productos de matrices por bloques de filas y columnas, de
+    modo que la memoria temporal queda acotada por `block_size` x `tile_size`. Se guarda como dos
+    arreglos compactos: IDs de vecinos (int32) y distancias (float32).
+
+    Permite dos usos en la búsqueda:
+      - `graph_neighbors`: obras similares a un resultado sin volver a extraer
+        características ni recorrer la base de datos.
+      - `rank_images_by_graph_search`: búsqueda voraz primero-el-mejor sobre el
+        grafo (estilo NSW), alternativa al recorrido lineal de
+        `rank_images_by_single_vector`.
+"""
+
+import os
+import heapq
+
+import numpy as np
+
+from search_engine.ranking import stack_vectors
+from search_engine.similarity import l2_dist_batch
+
+KNN_GRAPH_FILENAME = "knn_graph.npz"
+
+
+def build_knn_graph(matrix, k=16, block_size=1024, tile_size=4096):
+    """
+    Calcula los k vecinos más cercanos (distancia L2) de cada fila de la matriz.
+
+    Usa la identidad ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a·b para obtener las
+    distancias de un bloque de filas contra un bloque de columnas con un solo
+    producto de matrices. Cada bloque de filas recorre la matriz por bloques de
+    columnas y conserva un top-k parcial por fila, de modo que la memoria
+    temporal queda acotada por (block_size, tile_size + k) sin importar el
+    tamaño de la colección.
+
+    Args:
+        matrix (np.array): Matriz (n, d) de vectores.
+        k (int): Número de vecinos por nodo.
+        block_size (int): Filas procesadas por bloque.
+        tile_size (int): Columnas procesadas por bloque.
+
+    Returns:
+        tuple: (neighbors, distances), ambos de forma (n, k') con k' = min(k, n - 1),
+               ordenados de menor a mayor distancia.
+    """
+    n = matrix.shape[0]
+    k = min(k, n - 1)
+    neighbors = np.empty((n, max(k, 0)), dtype=np.int32)
+    distances = np.empty((n, max(k, 0)), dtype=np.float32)
+    if k <= 0:
+        return neighbors, distances
+
+    matrix = matrix.astype(np.float32)
+    sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = matrix[start:stop]
+        rows = np.arange(start, stop)
+
+        # Top-k parcial de cada fila del bloque
+        best_d2 = np.full((stop - start, k), np.inf, dtype=np.float32)
+        best_idx = np.zeros((stop - start, k), dtype=np.int64)
+
+        for col_start in range(0, n, tile_size):
+            col_stop = min(col_start + tile_size, n)
+            tile = matrix[col_start:col_stop]
+            d2 = sq_norms[start:stop, None] + sq_norms[None, col_start:col_stop] - 2.0 * (block @ tile.T)
+            # Un nodo no es vecino de sí mismo
+            cols = np.arange(col_start, col_stop)
+            d2[rows[:, None] == cols[None, :]] = np.inf
+
+            cand_d2 = np.concatenate([best_d2, d2], axis=1)
+            cand_idx = np.concatenate([best_idx, np.broadcast_to(cols, d2.shape)], axis=1)
+            nearest = np.argpartition(cand_d2, k - 1, axis=1)[:, :k]
+            best_d2 = np.take_along_axis(cand_d2, nearest, axis=1)
+            best_idx = np.take_along_axis(cand_idx, nearest, axis=1)
+
+        order = np.argsort(best_d2, axis=1)
+        neighbors[start:stop] = np.take_along_axis(best_idx, order, axis=1)
+        distances[start:stop] = np.sqrt(np.maximum(np.take_along_axis(best_d2, order, axis=1), 0.0))
+
+    return neighbors, distances
+
+
+def save_knn_graph(path, ids, neighbors, distances):
+    """
+    Guarda el grafo en un archivo .npz, reemplazando el anterior de forma atómica.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, ids=np.array(ids), neighbors=neighbors, distances=distances)
+    os.replace(tmp_path, path)
+
+
+def load_knn_graph(path):
+    """
+    Carga un grafo guardado con save_knn_graph.
+
+    Returns:
+        dict: Grafo con las claves 'ids' (lista), 'neighbors', 'distances' y
+              'position' (diccionario item_id -> fila). None si no existe.
+    """
+    try:
+        with np.load(path) as data:
+            ids = data["ids"].tolist()
+            graph = {"ids": ids, "neighbors": data["neighbors"], "distances": data["distances"]}
+    except FileNotFoundError:
+        return None
+    graph["position"] = {item_id: i for i, item_id in enumerate(ids)}
+    return graph
+
+
+def build_and_save_knn_graph(items, path, k=16, block_size=1024, tile_size=4096):
+    """
+    Construye y guarda el grafo kNN de una lista de items de la base de datos.
+
+    Args:
+        items (list): Items con el formato de database.json.
+        path (str): Ruta del archivo .npz de salida.
+        k (int): Número de vecinos por nodo.
+        block_size (int): Filas procesadas por bloque.
+        tile_size (int): Columnas procesadas por bloque.
+    """
+    db_vectors = [(item["id"], np.array(item["features"], dtype=np.float32))
+                  for item in items if "features" in item]
+    ids, matrix = stack_vectors(db_vectors)
+    neighbors, distances = build_knn_graph(matrix, k, block_size, tile_size)
+    save_knn_graph(path, ids, neighbors, distances)
+
+
+def graph_neighbors(graph, item_id, top_k=10, excluded=()):
+    """
+    Devuelve los vecinos precalculados de una obra de la base de datos.
+
+    Args:
+        graph (dict): Grafo cargado con load_knn_graph.
+        item_id (str): ID de la obra.
+        top_k (int): Número máximo de vecinos a devolver.
+        excluded (iterable): IDs que no deben aparecer (p. ej. lápidas).
+
+    Returns:
+        list: Tuplas (distancia, item_id) ordenadas. Vacía si la obra no está en el grafo.
+    """
+    row = graph["position"].get(item_id)
+    if row is None:
+        return []
+
+    excluded = set(excluded)
+    results = []
+    for j, dist in zip(graph["neighbors"][row], graph["distances"][row]):
+        neighbor_id = graph["ids"][j]
+        if neighbor_id not in excluded:
+            results.append((float(dist), neighbor_id))
+    return results[:top_k]
+
+
+def rank_images_by_graph_search(query_vector, graph, matrix, top_k=20, ef=64, n_entry=8):
+    """
+    Busca los vecinos de la consulta recorriendo el grafo kNN de forma voraz.
+
+    Parte de varios nodos de entrada repartidos por la base de datos y expande
+    siempre el candidato más cercano no visitado, manteniendo los 'ef' mejores
+    encontrados. Se detiene cuando el candidato más cercano ya es peor que el
+    peor de esos 'ef'. Solo calcula distancias para los nodos visitados.
+
+    Args:
+        query_vector (np.array): Vector concatenado de la imagen de consulta.
+        graph (dict): Grafo cargado con load_knn_graph.
+        matrix (np.array): Matriz de vectores alineada con graph['ids'].
+        top_k (int): El número de resultados a devolver.
+        ef (int): Tamaño de la lista dinámica de candidatos (mayor = más recall).
+        n_entry (int): Número de nodos de entrada.
+
+    Returns:
+        list: Una lista de tuplas (distancia, item_id) para los 'top_k' mejores resultados.
+    """
+    n = len(graph["ids"])
+    if n == 0 or query_vector.shape != (matrix.shape[1],):
+        return []
+
+    query_vector = query_vector.astype(np.float32)
+    ef = max(ef, top_k)
+
+    entries = np.unique(np.linspace(0, n - 1, min(n_entry, n)).astype(np.int64))
+    entry_dists = l2_dist_batch(query_vector, matrix[entries])
+    visited = set(entries.tolist())
+
+    candidates = [(float(d), int(i)) for d, i in zip(entry_dists, entries)]
+    heapq.heapify(candidates)
+    # Montículo de máximos (distancias negadas) con los 'ef' mejores
+    best = [(-d, i) for d, i in candidates]
+    heapq.heapify(best)
+    while len(best) > ef:
+        heapq.heappop(best)
+
+    while candidates:
+        dist, node = heapq.heappop(candidates)
+        if len(best) >= ef and dist > -best[0][0]:
+            break
+
+        new_nodes = [int(j) for j in graph["neighbors"][node] if j not in visited]
+        if not new_nodes:
+            continue
+        visited.update(new_nodes)
+
+        for d, j in zip(l2_dist_batch(query_vector, matrix[new_nodes]), new_nodes):
+            d = float(d)
+            if len(best) < ef or d < -best[0][0]:
+                heapq.heappush(candidates, (d, j))
+                heapq.heappush(best, (-d, j))
+                if len(best) > ef:
+                    heapq.heappop(best)
+
+    results = sorted((-neg_d, graph["ids"][i]) for neg_d, i in best)
+    return results[:top_k]
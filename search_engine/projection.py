@@ -0,0 +1,159 @@
+"""
+    Proyección PCA (con blanqueo opcional) del vector concatenado.
+
+    Los bloques del vector de 103 dimensiones tienen escalas muy distintas y
+    mucha redundancia (p. ej. bins del histograma LBP y la media de bytes ORB).
+    `build_database.py` puede ajustar una PCA sobre la matriz de características,
+    elegir la dimensión de salida según una varianza explicada objetivo y
+    guardar la proyección junto al índice. La búsqueda aplica la misma
+    proyección al vector de consulta y compara en el espacio reducido.
+"""
+
+import os
+import time
+
+import numpy as np
+
+from search_engine.ranking import rank_images_by_matrix, recall_at_k
+
+PROJECTION_FILENAME = "pca_projection.npz"
+
+# Constante para la estabilidad numérica en el blanqueo
+eps = 1e-10
+
+
+def fit_pca(matrix, target_variance=0.95, whiten=True):
+    """
+    Ajusta una PCA sobre la matriz de características.
+
+    Args:
+        matrix (np.array): Matriz (n, d) de vectores de la base de datos.
+        target_variance (float): Fracción de varianza explicada que deben
+                                 conservar los componentes elegidos (0-1].
+        whiten (bool): Si es True, cada componente se divide por su desviación
+                       estándar para que todos tengan varianza unitaria.
+
+    Returns:
+        dict: Proyección con las claves 'mean', 'components' (k, d), 'scales' (k,)
+              y 'explained_variance_ratio' (k,).
+    """
+    if not 0 < target_variance <= 1:
+        raise ValueError("target_variance debe estar en el intervalo (0, 1].")
+
+    matrix = matrix.astype(np.float64)
+    mean = matrix.mean(axis=0)
+    _, singular_values, vt = np.linalg.svd(matrix - mean, full_matrices=False)
+
+    variances = singular_values ** 2 / max(matrix.shape[0] - 1, 1)
+    ratios = variances / (variances.sum() + eps)
+    n_components = int(np.searchsorted(np.cumsum(ratios), target_variance - eps) + 1)
+    n_components = min(n_components, len(ratios))
+
+    if whiten:
+        scales = 1.0 / np.sqrt(variances[:n_components] + eps)
+    else:
+        scales = np.ones(n_components)
+
+    return {
+        "mean": mean.astype(np.float32),
+        "components": vt[:n_components].astype(np.float32),
+        "scales": scales.astype(np.float32),
+        "explained_variance_ratio": ratios[:n_components].astype(np.float32),
+    }
+
+
+def apply_projection(projection, vectors):
+    """
+    Proyecta un vector (d,) o una matriz (n, d) al espacio de la PCA.
+    """
+    centered = vectors.astype(np.float32) - projection["mean"]
+    return (centered @ projection["components"].T) * projection["scales"]
+
+
+def save_projection(path, projection):
+    """
+    Guarda la proyección en un archivo .npz, reemplazando la anterior de forma atómica.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **projection)
+    os.replace(tmp_path, path)
+
+
+def load_projection(path):
+    """
+    Carga una proyección guardada con save_projection. None si no existe.
+    """
+    try:
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+    except FileNotFoundError:
+        return None
+
+
+def _precision_at_k(results, query_label, labels_by_id):
+    if not results:
+        return 0.0
+    return sum(1 for _, item_id in results if labels_by_id[item_id] == query_label) / len(results)
+
+
+def projection_report(ids, matrix, labels, projection, top_k=10):
+    """
+    Compara la búsqueda con el vector completo y con el vector proyectado.
+
+    Cada vector de la base de datos se usa como consulta (excluyéndose a sí
+    mismo del ranking) con un recorrido lineal L2 en ambos espacios.
+
+    Args:
+        ids (list): IDs alineados con las filas de la matriz.
+        matrix (np.array): Matriz (n, d) de vectores completos.
+        labels (list): Clase de cada fila, usada para la precisión.
+        projection (dict): Proyección creada con fit_pca.
+        top_k (int): Tamaño del ranking evaluado.
+
+    Returns:
+        dict: Métricas por espacio ('full' y 'pca'): dimensión, precisión@k
+              media y latencia media por consulta en milisegundos, además del
+              recall@k del espacio proyectado frente al completo.
+    """
+    labels_by_id = dict(zip(ids, labels))
+    projected = apply_projection(projection, matrix)
+
+    report = {}
+    rankings = {}
+    for name, space in (("full", matrix), ("pca", projected)):
+        precisions = []
+        rankings[name] = []
+        start = time.perf_counter()
+        for i in range(len(ids)):
+            results = rank_images_by_matrix(space[i], ids, space, top_k + 1)
+            results = [r for r in results if r[1] != ids[i]][:top_k]
+            rankings[name].append(results)
+        elapsed = time.perf_counter() - start
+
+        for i, results in enumerate(rankings[name]):
+            precisions.append(_precision_at_k(results, labels[i], labels_by_id))
+
+        report[name] = {
+            "dim": space.shape[1],
+            "precision": float(np.mean(precisions)) if precisions else 0.0,
+            "latency_ms": 1000.0 * elapsed / max(len(ids), 1),
+        }
+
+    recalls = [recall_at_k(p, f) for p, f in zip(rankings["pca"], rankings["full"])]
+    report["recall"] = float(np.mean(recalls)) if recalls else 0.0
+    return report
+
+
+def format_projection_report(report, top_k=10):
+    """
+    Devuelve el reporte de projection_report como una tabla de texto.
+    """
+    lines = [
+        f"{'':<22}{'Completo':>12}{'PCA':>12}",
+        f"{'Dimensión':<22}{report['full']['dim']:>12d}{report['pca']['dim']:>12d}",
+        f"{f'Precisión@{top_k}':<22}{report['full']['precision']:>12.4f}{report['pca']['precision']:>12.4f}",
+        f"{'Latencia (ms/consulta)':<22}{report['full']['latency_ms']:>12.3f}{report['pca']['latency_ms']:>12.3f}",
+        f"Recall@{top_k} de PCA frente al vector completo: {report['recall']:.2%}",
+    ]
+    return "\n".join(lines)
@@ -9,10 +9,25 @@
     El flujo principal es manejado por la función `rank_images`, que utiliza
     funciones auxiliares para calcular distancias individuales y combinarlas
     según pesos definidos.
+
+    También incluye un ranking en cascada (`rank_images_cascade`) que primero
+    filtra toda la base de datos con los bloques baratos del vector concatenado
+    y solo calcula las distancias costosas para los candidatos que sobreviven.
 """
 
 import numpy as np
 
+from extractors.normalize_features import FEATURE_ORDER, FEATURE_DIMS, feature_block_slices
+from search_engine.similarity import l2_dist_batch, chi_square_batch
+
+# Etapas por defecto de la cascada: cada etapa indica los bloques del vector
+# que compara, la métrica y cuántos candidatos conserva (None = top_k).
+DEFAULT_CASCADE_STAGES = [
+    {"blocks": ["color_moments", "haralick_features"], "metric": "l2", "keep": 300},
+    {"blocks": ["lbp_histogram"], "metric": "chi_square", "keep": 100},
+    {"blocks": FEATURE_ORDER, "metric": "l2", "keep": None},
+]
+
 def weighted_distance(dist_dict, weights):
     """
     Calcula la distancia final como una suma ponderada de distancias individuales.
@@ -137,4 +152,266 @@ def rank_images_by_single_vector(query_vector, db_vectors, distance_fn, top_k=20
     # Ordenar los resultados por distancia (ascendente)
     results.sort(key=lambda x: x[0])
 
-    return results[:top_k]
\ No newline at end of file
+    return results[:top_k]
+
+
+def stack_vectors(db_vectors):
+    """
+    Apila los vectores concatenados de la base de datos en una matriz.
+
+    Args:
+        db_vectors (list): Lista de tuplas (item_id, vector_concatenado).
+
+    Returns:
+        tuple: (ids, matriz) donde la fila i de la matriz (float32) corresponde
+               a ids[i]. Se omiten los vectores vacíos o con otra dimensión.
+    """
+    dim = sum(FEATURE_DIMS.values())
+    ids = []
+    rows = []
+    for item_id, db_vector in db_vectors:
+        if db_vector.shape == (dim,):
+            ids.append(item_id)
+            rows.append(db_vector)
+
+    if rows:
+        return ids, np.vstack(rows).astype(np.float32)
+    return ids, np.empty((0, dim), dtype=np.float32)
+
+
+def rank_images_by_matrix(query_vector, ids, matrix, top_k=20):
+    """
+    Recorre linealmente una matriz de vectores con distancia L2 vectorizada.
+
+    Es equivalente a rank_images_by_single_vector con l2_dist, pero compara la
+    consulta contra todas las filas en una sola operación.
+
+    Args:
+        query_vector (np.array): Vector de la imagen de consulta.
+        ids (list): IDs alineados con las filas de la matriz.
+        matrix (np.array): Matriz (n, d) de vectores de la base de datos.
+        top_k (int): El número de resultados a devolver.
+
+    Returns:
+        list: Una lista de tuplas (distancia, item_id) para los 'top_k' mejores resultados.
+    """
+    if not ids or query_vector.shape != (matrix.shape[1],):
+        return []
+
+    dists = l2_dist_batch(query_vector.astype(np.float32), matrix)
+    if top_k < len(dists):
+        best = np.argpartition(dists, top_k - 1)[:top_k]
+    else:
+        best = np.arange(len(dists))
+    best = best[np.argsort(dists[best])]
+    return [(float(dists[i]), ids[i]) for i in best]
+
+
+def build_cascade_index(db_vectors):
+    """
+    Prepara los vectores de la base de datos para el ranking en cascada.
+
+    Apila los vectores en una matriz y guarda cada bloque de características
+    (color, LBP, Haralick, ORB) en un arreglo contiguo propio, de modo que las
+    etapas baratas solo lean de memoria las columnas que necesitan.
+
+    Args:
+        db_vectors (list): Lista de tuplas (item_id, vector_concatenado).
+
+    Returns:
+        dict: Índice con las claves 'ids' (lista de IDs) y 'blocks'
+              (diccionario bloque -> matriz de forma (n, dim_bloque)).
+    """
+    ids, matrix = stack_vectors(db_vectors)
+
+    blocks = {}
+    for key, block_slice in feature_block_slices().items():
+        blocks[key] = np.ascontiguousarray(matrix[:, block_slice])
+
+    return {"ids": ids, "blocks": blocks}
+
+
+def cascade_stages_for(coarse_keep, lbp_keep):
+    """
+    Devuelve las etapas de DEFAULT_CASCADE_STAGES con otros tamaños intermedios.
+
+    Args:
+        coarse_keep (int): Candidatos tras la etapa de color + Haralick.
+        lbp_keep (int): Candidatos tras la etapa Chi-cuadrado de LBP. Se limita a
+                        'coarse_keep', ya que una etapa no puede conservar más
+                        candidatos de los que recibe.
+
+    Returns:
+        list: Lista de etapas para rank_images_cascade.
+    """
+    return [
+        dict(DEFAULT_CASCADE_STAGES[0], keep=int(coarse_keep)),
+        dict(DEFAULT_CASCADE_STAGES[1], keep=int(min(lbp_keep, coarse_keep))),
+        DEFAULT_CASCADE_STAGES[2],
+    ]
+
+
+def _stage_distances(query_blocks, index, stage, rows=None):
+    """
+    Calcula las distancias de una etapa de la cascada.
+
+    Tanto la distancia L2 al cuadrado como Chi-cuadrado se descomponen en una
+    suma por bloques, así que cada bloque se compara por separado y luego se
+    combinan los resultados.
+
+    Args:
+        query_blocks (dict): Bloques del vector de consulta.
+        index (dict): Índice creado por build_cascade_index.
+        stage (dict): Definición de la etapa ('blocks', 'metric', 'keep').
+        rows (np.array): Filas candidatas a comparar. Si es None se recorre
+                         toda la base de datos.
+
+    Returns:
+        np.array: Distancias de la etapa para cada fila comparada.
+    """
+    total = None
+    for key in stage["blocks"]:
+        block = index["blocks"][key]
+        if rows is not None:
+            block = block[rows]
+
+        if stage["metric"] == "l2":
+            partial = l2_dist_batch(query_blocks[key], block) ** 2
+        elif stage["metric"] == "chi_square":
+            partial = chi_square_batch(query_blocks[key], block)
+        else:
+            raise ValueError(f"Métrica desconocida en la cascada: {stage['metric']}")
+
+        total = partial if total is None else total + partial
+
+    if stage["metric"] == "l2":
+        total = np.sqrt(total)
+    return total
+
+
+def rank_images_cascade(query_vector, index, stages=None, top_k=20):
+    """
+    Ordena la base de datos con un ranking en cascada de grueso a fino.
+
+    La primera etapa recorre toda la base de datos comparando solo los bloques
+    de baja dimensión y conserva los mejores max('keep', top_k) candidatos. Cada etapa
+    siguiente vuelve a ordenar únicamente a los sobrevivientes de la anterior
+    con bloques más costosos. La última etapa define la distancia devuelta.
+
+    Args:
+        query_vector (np.array): Vector concatenado de la imagen de consulta.
+        index (dict): Índice creado por build_cascade_index.
+        stages (list): Lista de etapas. Si es None se usa DEFAULT_CASCADE_STAGES.
+        top_k (int): El número de resultados a devolver.
+
+    Returns:
+        list: Una lista de tuplas (distancia, item_id) para los 'top_k' mejores resultados.
+    """
+    if stages is None:
+        stages = DEFAULT_CASCADE_STAGES
+
+    dim = sum(FEATURE_DIMS.values())
+    if query_vector.shape != (dim,) or not index["ids"]:
+        return []
+
+    query_vector = query_vector.astype(np.float32)
+    query_blocks = {key: query_vector[block_slice]
+                    for key, block_slice in feature_block_slices().items()}
+
+    rows = None
+    dists = None
+    for stage in stages:
+        dists = _stage_distances(query_blocks, index, stage, rows)
+        if rows is None:
+            rows = np.arange(len(dists))
+
+        # Ninguna etapa puede quedarse con menos candidatos que los pedidos:
+        # search_segments pide top_k extra para compensar IDs ocultos
+        keep = max(stage["keep"], top_k) if stage["keep"] is not None else top_k
+        if keep < len(dists):
+            # Selección parcial: solo interesan los 'keep' más cercanos
+            best = np.argpartition(dists, keep - 1)[:keep]
+            rows, dists = rows[best], dists[best]
+
+    order = np.argsort(dists)[:top_k]
+    return [(float(dists[i]), index["ids"][rows[i]]) for i in order]
+
+
+def cascade_recall(query_vector, index, stages=None, top_k=20, exclude_id=None):
+    """
+    Mide el recall de la cascada frente a la búsqueda exhaustiva.
+
+    La búsqueda exhaustiva usa la métrica y los bloques de la última etapa sobre
+    toda la base de datos, que es el ranking que la cascada intenta aproximar.
+
+    Args:
+        query_vector (np.array): Vector concatenado de la imagen de consulta.
+        index (dict): Índice creado por build_cascade_index.
+        stages (list): Lista de etapas. Si es None se usa DEFAULT_CASCADE_STAGES.
+        top_k (int): Tamaño del ranking a comparar.
+        exclude_id (str): ID que se quita de ambos rankings (p. ej. la propia
+                          consulta cuando es una obra de la base de datos).
+
+    Returns:
+        float: Fracción de los 'top_k' exhaustivos recuperados por la cascada.
+    """
+    if stages is None:
+        stages = DEFAULT_CASCADE_STAGES
+
+    fetch_k = top_k + 1 if exclude_id is not None else top_k
+    cascade = rank_images_cascade(query_vector, index, stages, fetch_k)
+    exhaustive = rank_images_cascade(query_vector, index, [stages[-1]], fetch_k)
+    cascade = [r for r in cascade if r[1] != exclude_id][:top_k]
+    exhaustive = [r for r in exhaustive if r[1] != exclude_id][:top_k]
+    return recall_at_k(cascade, exhaustive)
+
+
+def sample_cascade_recall(index, stages=None, top_k=20, sample_size=50, seed=0):
+    """
+    Estima el recall de la cascada usando obras de la base de datos como consultas.
+
+    Pensado para medirse fuera de la ruta de cada búsqueda (p. ej. una vez por
+    configuración de etapas), ya que cada consulta exige un recorrido exhaustivo.
+    Cada consulta se excluye de ambos rankings, igual que en projection_report,
+    para que su coincidencia consigo misma no infle el recall.
+
+    Args:
+        index (dict): Índice creado por build_cascade_index.
+        stages (list): Lista de etapas. Si es None se usa DEFAULT_CASCADE_STAGES.
+        top_k (int): Tamaño del ranking a comparar.
+        sample_size (int): Número de consultas de la muestra.
+        seed (int): Semilla para elegir la muestra.
+
+    Returns:
+        float: Recall medio de la muestra (0.0 si el índice está vacío).
+    """
+    n = len(index["ids"])
+    if n == 0:
+        return 0.0
+
+    rows = np.random.default_rng(seed).choice(n, size=min(sample_size, n), replace=False)
+    # Se reconstruye el vector concatenado de cada fila a partir de sus bloques
+    recalls = []
+    for row in rows:
+        query_vector = np.concatenate([index["blocks"][key][row] for key in FEATURE_ORDER])
+        recalls.append(cascade_recall(query_vector, index, stages, top_k, exclude_id=index["ids"][row]))
+    return float(np.mean(recalls))
+
+
+def recall_at_k(results, reference):
+    """
+    Calcula qué fracción de un ranking de referencia aparece en otro ranking.
+
+    Args:
+        results (list): Tuplas (distancia, item_id) del ranking a evaluar.
+        reference (list): Tuplas (distancia, item_id) del ranking exacto.
+
+    Returns:
+        float: Fracción de IDs de 'reference' presentes en 'results'.
+    """
+    if not reference:
+        return 0.0
+
+    result_ids = {item_id for _, item_id in results}
+    hits = sum(1 for _, item_id in reference if item_id in result_ids)
+    return hits / len(reference)
@@ -59,3 +59,37 @@ def hamming_dist(bin1, bin2):
         float: Distancia de Hamming normalizada entre 0 y 1.
     """
     return np.mean(np.not_equal(bin1, bin2))
+
+
+def chi_square_batch(h, H):
+    """
+    Calcula la distancia Chi-cuadrado entre un histograma y cada fila de una matriz.
+
+    Es la versión vectorizada de chi_square, pensada para comparar la consulta
+    contra muchos elementos de la base de datos en una sola operación.
+
+    Args:
+        h: Histograma de consulta con forma (d,).
+        H: Matriz de histogramas con forma (n, d).
+
+    Returns:
+        np.ndarray: Vector de n distancias Chi-cuadrado.
+    """
+    num = (H - h)**2
+    den = H + h + eps
+    return 0.5 * np.sum(num / den, axis=1)
+
+def l2_dist_batch(x, X):
+    """
+    Calcula la distancia Euclidiana entre un vector y cada fila de una matriz.
+
+    Es la versión vectorizada de l2_dist.
+
+    Args:
+        x: Vector de consulta con forma (d,).
+        X: Matriz de vectores con forma (n, d).
+
+    Returns:
+        np.ndarray: Vector de n distancias Euclidianas.
+    """
+    return np.linalg.norm(X - x, axis=1)
@@ -0,0 +1,114 @@
+"""
+Herramienta de línea de comandos para actualizar el índice sin reconstruirlo.
+
+Ejemplos:
+    python update_index.py add ruta/obra.jpg --genre Baroque
+    python update_index.py delete al-held_untitled-1954
+    python update_index.py compact
+    python update_index.py compact --watch --interval 300 --min-segments 4
+"""
+
+import os
+import time
+import shutil
+import argparse
+
+from build_database import create_entry
+from search_engine.index_store import (
+    DATA_DIR, append_segment, delete_items, compact_index, start_background_compaction
+)
+
+DATASET_FOLDER = 'dataset/wikiart'
+
+
+def _dataset_files_by_id():
+    """
+    Devuelve un diccionario id -> ruta de todas las imágenes del dataset.
+    """
+    files = {}
+    for genre_folder_name in os.listdir(DATASET_FOLDER):
+        class_path = os.path.join(DATASET_FOLDER, genre_folder_name)
+        if not os.path.isdir(class_path): continue
+        for filename in os.listdir(class_path):
+            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                files[os.path.splitext(filename)[0]] = os.path.join(class_path, filename)
+    return files
+
+
+def add_images(image_paths, genre):
+    """
+    Agrega imágenes al índice en un segmento nuevo y las copia al dataset.
+
+    Copiarlas a `dataset/wikiart/<genre>/` garantiza que una reconstrucción
+    completa con build_database.py también las incluya. Las características se
+    extraen antes de copiar, para no dejar en el dataset imágenes que no se
+    pueden procesar, y se rechazan las imágenes cuyo ID ya existe en el
+    dataset (en cualquier género), porque la reconstrucción tendría dos
+    archivos con el mismo ID.
+    """
+    genre_path = os.path.join(DATASET_FOLDER, genre)
+    os.makedirs(genre_path, exist_ok=True)
+    existing = _dataset_files_by_id()
+
+    entries = []
+    for image_path in image_paths:
+        target_path = os.path.join(genre_path, os.path.basename(image_path))
+        item_id = os.path.splitext(os.path.basename(image_path))[0]
+        in_place = os.path.abspath(image_path) == os.path.abspath(target_path)
+
+        if item_id in existing and not in_place:
+            print(f"    -> Omitida {image_path}: el ID '{item_id}' ya existe en {existing[item_id]}")
+            continue
+
+        try:
+            entry = create_entry(image_path, genre)
+        except Exception as e:
+            print(f"    -> Error procesando {image_path}: {e}")
+            continue
+
+        if not in_place:
+            shutil.copy2(image_path, target_path)
+        entry["image_path"] = target_path
+        existing[item_id] = target_path
+        entries.append(entry)
+        print(f"  - Procesada: {target_path}")
+
+    if entries:
+        segment_name = append_segment(entries, DATA_DIR)
+        print(f"{len(entries)} obras agregadas en el segmento '{segment_name}'.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Actualiza el índice de características en línea.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="Agrega imágenes en un segmento nuevo.")
+    add_parser.add_argument("images", nargs="+")
+    add_parser.add_argument("--genre", required=True, help="Carpeta de género dentro del dataset.")
+
+    delete_parser = subparsers.add_parser("delete", help="Registra lápidas para los IDs indicados.")
+    delete_parser.add_argument("ids", nargs="+")
+
+    compact_parser = subparsers.add_parser("compact", help="Fusiona los segmentos en la base principal.")
+    compact_parser.add_argument("--watch", action="store_true", help="Compacta periódicamente en segundo plano.")
+    compact_parser.add_argument("--interval", type=float, default=300.0)
+    compact_parser.add_argument("--min-segments", type=int, default=4)
+
+    args = parser.parse_args()
+
+    if args.command == "add":
+        add_images(args.images, args.genre)
+    elif args.command == "delete":
+        delete_items(args.ids, DATA_DIR)
+        print(f"{len(args.ids)} obras marcadas como eliminadas.")
+    elif args.watch:
+        start_background_compaction(DATA_DIR, args.interval, args.min_segments)
+        print("Compactación en segundo plano activa. Ctrl+C para detener.")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+    else:
+        merged = compact_index(DATA_DIR)
+        print(f"Compactación completada: {merged} segmentos fusionados.")